@@ -17,27 +17,49 @@ Usage:
     hyprkan [options]
 
 Dependencies:
-- Python >= 3.8
+- Python >= 3.9
 - kanata >= 1.8.1
 - i3ipc (for Sway)
 - python-xlib (for X11)
+- orjson (optional, faster config loading)
 """
 
 import argparse
+import errno
+import functools
+import heapq
+import ipaddress
 import json
 import logging
 import os
 import re
+import select
+import selectors
 import signal
 import socket
-import subprocess
+import stat
 import sys
-import threading
 from time import sleep
 from dataclasses import dataclass
 from datetime import datetime
+from operator import attrgetter
 from pathlib import Path
-from typing import Literal, NoReturn, Optional, TypedDict, Tuple, Dict, Any, Union
+from typing import (
+    TYPE_CHECKING,
+    Literal,
+    NamedTuple,
+    NoReturn,
+    Optional,
+    TypedDict,
+    Tuple,
+    Dict,
+    Any,
+    Union,
+)
+
+if TYPE_CHECKING:
+    import subprocess
+    from concurrent.futures import Future, ThreadPoolExecutor
 
 
 SCRIPT_VERSION = "2.2.0"
@@ -45,8 +67,29 @@ SCRIPT_VERSION = "2.2.0"
 
 log = logging.getLogger()
 
+# Bytes of a command's stderr kept for its failure message
+_STDERR_TAIL = 8192
 
-class Rule(TypedDict, total=False):
+# Commands made of plain words only, which run the same with or without a shell
+_SIMPLE_CMD_RE = re.compile(r"[ \t]*[\w./:,=+@%-]+(?:[ \t]+[\w./:,=+@%-]+)*[ \t]*")
+
+# Actions accepted by kanata's ActOnFakeKey, by their case-insensitive spelling
+_FAKE_KEY_ACTIONS = {
+    "press": "Press",
+    "release": "Release",
+    "tap": "Tap",
+    "toggle": "Toggle",
+}
+
+# JSON insignificant whitespace between kanata messages
+_JSON_WS_RE = re.compile(r"[ \t\n\r]*")
+
+# Characters that make a rule value a regular expression rather than a plain
+# substring.
+_REGEX_META = frozenset("\\.^$*+?{}[]|()")
+
+
+class RuleDict(TypedDict, total=False):
     layer: str
     cls: str
     title: str
@@ -55,27 +98,77 @@ class Rule(TypedDict, total=False):
     set_mouse: tuple[int, int]
 
 
-class WinInfo(TypedDict):
+@dataclass(frozen=True)
+class Rule:
+    """A validated config rule, as returned by `Config.detect_rule`."""
+
+    __slots__ = ("cls", "title", "layer", "cmd", "fake_key", "set_mouse")
+
+    cls: Optional[str]
+    title: Optional[str]
+    layer: Optional[str]
+    cmd: Optional[str]
+    fake_key: Optional[tuple[str, str]]
+    set_mouse: Optional[tuple[int, int]]
+
+    @classmethod
+    def from_dict(cls, data: RuleDict) -> "Rule":
+        # JSON arrays become tuples, so the frozen rule stays hashable
+        fake_key, set_mouse = data.get("fake_key"), data.get("set_mouse")
+        return cls(
+            data.get("class"),
+            data.get("title"),
+            data.get("layer"),
+            data.get("cmd"),
+            tuple(fake_key) if isinstance(fake_key, list) else fake_key,
+            tuple(set_mouse) if isinstance(set_mouse, list) else set_mouse,
+        )
+
+    def as_dict(self) -> RuleDict:
+        """Return the rule as it is written in the config, leaving out unset keys."""
+        keys = ("class",) + self.__slots__[1:]  # `class` is a keyword
+        values = (getattr(self, name) for name in self.__slots__)
+        return {
+            k: list(v) if isinstance(v, tuple) else v
+            for k, v in zip(keys, values)
+            if v is not None
+        }
+
+
+class WinInfo(NamedTuple):
     cls: str
     title: str
 
 
+# How a rule's class/title value is matched, cheapest first. Values without
+# regex syntax (optionally anchored with ^ and $) don't need the regex engine.
+_MATCH_ANY = 0  # "*", missing or disabled
+_MATCH_EQUALS = 1  # ^literal$
+_MATCH_PREFIX = 2  # ^literal
+_MATCH_SUFFIX = 3  # literal$
+_MATCH_CONTAINS = 4  # literal
+_MATCH_REGEX = 5  # anything else, precompiled
+
+# (kind, payload): payload is the literal, the compiled pattern, or None
+Matcher = Tuple[int, Union[None, str, re.Pattern]]
+
+
 # pylint: disable=invalid-name
 class utils:
 
     @staticmethod
     def is_blank(s: str) -> bool:
         """Check if a string is empty/whitespace only."""
-        return not s.strip()
+        return not s or s.isspace()
 
     @staticmethod
     def validate_port(port: Union[int, str]) -> tuple[str, int]:
         """Validate a port number or an IP:PORT combination and return (host, port)."""
         port_str = str(port)
-        if utils._is_valid_port(port_str):
-            return ("127.0.0.1", int(port_str))  # default host localhost
-        if utils._is_valid_ip_port(port_str):
-            host, port_part = port_str.split(":")
+        host, sep, port_part = port_str.rpartition(":")
+        if not sep:
+            host = "127.0.0.1"  # default host localhost
+        if utils._is_valid_port(port_part) and (not sep or utils._is_valid_ip(host)):
             return (host, int(port_part))
 
         fatal(
@@ -95,43 +188,208 @@ class utils:
     def _is_valid_port(port: Union[int, str]) -> bool:
         if isinstance(port, int):
             return 0 < port <= 65535
-        if isinstance(port, str) and port.isdigit():
+        if isinstance(port, str) and port.isdecimal():  # isdigit() accepts "²"
             val = int(port)
             return 0 < val <= 65535
         return False
 
     @staticmethod
-    def _is_valid_ip_port(value: str) -> bool:
-        pattern = r"(\d{1,3}(?:\.\d{1,3}){3}):(\d{1,5})"
-        match = re.fullmatch(pattern, value)
-        if not match:
+    def _is_valid_ip(host: str) -> bool:
+        try:
+            ipaddress.IPv4Address(host)
+        except ValueError:
             return False
+        return True
 
-        ip, port_str = match.groups()
-        port = int(port_str)
+    # Shared workers waiting on background commands, created on first use
+    _cmd_pool: Optional["ThreadPoolExecutor"] = None
+    # Commands still running after the pool's grace period, for the reaper thread
+    _reap_queue: Optional["queue.SimpleQueue"] = None
 
-        if not utils._is_valid_port(port):
-            return False
+    @staticmethod
+    def run_cmd_bg(cmd: str) -> Optional["Future"]:
+        """Execute a shell command in the background without waiting for it."""
+        # Only needed once a rule runs a command, so CLI invocations skip them
+        # pylint: disable=import-outside-toplevel
+        import queue
+        import subprocess
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+
+        def spawn(argv: Union[str, list[str]]) -> subprocess.Popen:
+            # pylint: disable=consider-using-with
+            return subprocess.Popen(
+                argv,
+                shell=isinstance(argv, str),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                start_new_session=True,
+            )
 
-        if ip == "localhost":
-            return True
+        args = utils._split_simple_cmd(cmd)
+        try:
+            try:
+                proc = spawn(cmd if args is None else args)
+            except FileNotFoundError:
+                if args is None:
+                    raise
+                # Moved or removed since it was looked up; sh searches PATH again
+                utils._which.cache_clear()
+                proc = spawn(cmd)
+            except OSError as e:
+                if args is None or e.errno != errno.ENOEXEC:
+                    raise
+                proc = spawn(cmd)  # a script without a shebang, which sh runs itself
+        except OSError as e:
+            log.error("Error occurred while running command '%s': %s", cmd, e)
+            return None
+
+        if utils._cmd_pool is None:
+            utils._cmd_pool = ThreadPoolExecutor(
+                max_workers=4, thread_name_prefix="hyprkan-cmd"
+            )
+            utils._reap_queue = queue.SimpleQueue()
+            threading.Thread(
+                target=utils._reap_cmds,
+                args=(utils._reap_queue,),
+                name="hyprkan-cmd-reaper",
+                daemon=True,
+            ).start()
+        return utils._cmd_pool.submit(utils._wait_cmd, proc, cmd)
+
+    @staticmethod
+    def stop_cmds():
+        """Drop queued command reaping so exiting doesn't wait on it."""
+        if utils._cmd_pool is not None:
+            utils._cmd_pool.shutdown(wait=False, cancel_futures=True)
 
-        octets = ip.split(".")
-        return all(o.isdigit() and 0 <= int(o) <= 255 for o in octets)
+    @staticmethod
+    def _split_simple_cmd(cmd: str) -> Optional[list[str]]:
+        """
+        Return the argv of a command that needs nothing from the shell, with the
+        program resolved to its absolute path, so it can be exec'd directly.
+        Returns None for anything involving quoting, expansion, redirection,
+        variable assignments or programs not found on PATH.
+        """
+        if not _SIMPLE_CMD_RE.fullmatch(cmd):
+            return None
+        args = cmd.split()
+        if "=" in args[0]:
+            return None  # `VAR=value cmd`
+        path = utils._which(args[0])
+        if path is None:
+            return None  # builtin or missing, let the shell handle (and report) it
+        args[0] = path
+        return args
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _which(name: str) -> Optional[str]:
+        import shutil  # pylint: disable=import-outside-toplevel
+
+        return shutil.which(name)
+
+    @staticmethod
+    def _wait_cmd(proc: "subprocess.Popen", cmd: str):
+        """Reap a background command and log it if it failed."""
+        # pylint: disable=import-outside-toplevel
+        import subprocess
+
+        try:
+            proc.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            # Long-lived commands (GUI apps) are left to the reaper thread, so they
+            # neither occupy a worker nor cost a thread each.
+            utils._reap_queue.put((proc, cmd))
+            return
+
+        stderr = bytearray()
+        utils._drain_stderr(proc, stderr)
+        utils._log_failed_cmd(proc, cmd, stderr)
+
+    @staticmethod
+    def _reap_cmds(pending: "queue.SimpleQueue"):
+        """Collect commands handed over by `_wait_cmd` until they exit."""
+        import queue  # pylint: disable=import-outside-toplevel
+
+        sel = selectors.DefaultSelector()
+        running: Dict["subprocess.Popen", Tuple[str, bytearray]] = {}
+        while True:
+            handed_over = []
+            try:
+                # Sleep until there's something to watch
+                handed_over.append(pending.get(block=not running))
+                while True:
+                    handed_over.append(pending.get_nowait())
+            except queue.Empty:
+                pass
+            for proc, cmd in handed_over:
+                running[proc] = (cmd, bytearray())
+                os.set_blocking(proc.stderr.fileno(), False)
+                sel.register(proc.stderr, selectors.EVENT_READ, proc)
+
+            # Keep reading stderr so a chatty command never blocks on a full pipe,
+            # and check for exits at least once a second
+            for key, _ in sel.select(timeout=1):
+                if utils._drain_stderr(key.data, running[key.data][1]):
+                    sel.unregister(key.fileobj)
+
+            for proc in [proc for proc in running if proc.poll() is not None]:
+                cmd, stderr = running.pop(proc)
+                if proc.stderr in sel.get_map():
+                    sel.unregister(proc.stderr)
+                utils._drain_stderr(proc, stderr)
+                utils._log_failed_cmd(proc, cmd, stderr)
 
     @staticmethod
-    def _run_cmd(cmd: str):
-        """Run a shell command and handle errors."""
+    def _drain_stderr(proc: "subprocess.Popen", buf: bytearray) -> bool:
+        """
+        Append what can be read from `proc`'s stderr without blocking to `buf`,
+        keeping its last `_STDERR_TAIL` bytes. Returns True once the pipe is at EOF.
+        """
+        fd = proc.stderr.fileno()
+        os.set_blocking(fd, False)  # a backgrounded child may hold the pipe open
         try:
-            subprocess.run(cmd, shell=True, capture_output=True, text=True, check=True)
-        except subprocess.CalledProcessError as e:
-            fatal("Error occurred while running command: %s\n%s", e, e.stderr)
+            while True:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    return True
+                buf += chunk
+                del buf[:-_STDERR_TAIL]
+        except BlockingIOError:
+            return False
 
     @staticmethod
-    def run_cmd_bg(cmd: str):
-        """Execute a shell command in the background."""
-        thread = threading.Thread(target=utils._run_cmd, args=(cmd,))
-        thread.start()
+    def _log_failed_cmd(proc: "subprocess.Popen", cmd: str, stderr: bytearray):
+        proc.stderr.close()
+        if proc.returncode != 0:
+            log.error(
+                "Error occurred while running command '%s': exit status %d\n%s",
+                cmd,
+                proc.returncode,
+                stderr.decode(errors="replace"),
+            )
+
+    @staticmethod
+    def pop_lines(buf: bytearray) -> list[bytes]:
+        """Remove all complete newline-terminated lines from `buf` and return them."""
+        end = buf.rfind(b"\n")
+        if end == -1:
+            return []
+        lines = bytes(buf[:end]).split(b"\n")
+        del buf[: end + 1]  # keep only the incomplete tail
+        return lines
+
+    @staticmethod
+    def recv_until_eof(sock: socket.socket) -> bytearray:
+        """Read from `sock` until the peer closes the connection."""
+        buf = bytearray()
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                return buf
+            buf += chunk
 
     @staticmethod
     def require_env(var_name: str) -> str:
@@ -149,40 +407,71 @@ class utils:
         if utils.is_blank(name):
             fatal("Fake key name must not be blank")
 
-        valid_actions = {"Press", "Release", "Tap", "Toggle"}
-        action = action.capitalize()
-        if action not in valid_actions:
-            actions = ", ".join(valid_actions)
+        canonical = _FAKE_KEY_ACTIONS.get(action.casefold())
+        if canonical is None:
+            action = action.capitalize()
+            actions = ", ".join(_FAKE_KEY_ACTIONS.values())
             if rule_no:
                 msg = f"Invalid config: rule #{rule_no} '{action}' must be one of: {actions}"
             else:
                 msg = f"Invalid action '{action}'. Must be one of: {actions}"
             fatal(msg)
 
-        return name, action
+        return name, canonical
 
 
+# pylint: disable=too-many-instance-attributes
 class Kanata:
     """TCP client for communicating with kanata."""
 
+    # Pre-encoded requests; only the leaf values of the templates vary
+    _MSG_CURRENT_LAYER_NAME = b'{"RequestCurrentLayerName":{}}\n'
+    _MSG_CURRENT_LAYER_INFO = b'{"RequestCurrentLayerInfo":{}}\n'
+    _MSG_LAYER_NAMES = b'{"RequestLayerNames":{}}\n'
+    _TPL_CHANGE_LAYER = b'{"ChangeLayer":{"new":%b}}\n'
+    _TPL_FAKE_KEY = b'{"ActOnFakeKey":{"name":%b,"action":%b}}\n'
+    _TPL_SET_MOUSE = b'{"SetMouse":{"x":%d,"y":%d}}\n'
+
     def __init__(self, addr: Tuple[str, int]):
         self.addr = addr
         self._client: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._buffer = ""
+        self._buffer = bytearray()
+        self._chunk = memoryview(bytearray(4096))  # reused receive buffer
+        self._selector: Optional[selectors.BaseSelector] = None  # per connection
+        self._decoder = json.JSONDecoder()
         self._connected = False
+        self._opening = False  # a connection is being set up, don't reconnect
+        # Last layer reported by kanata; kept in sync with LayerChange messages
+        self._current_layer: Optional[str] = None
+        self._layer_names: Optional[list[str]] = None
 
-    def _connect(self):
-        log.debug("Connecting to %s:%s", *self.addr)
-        try:
-            self._client.connect(self.addr)
-            self._client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            self._client.settimeout(0.5)
-            self._connected = True
+    @staticmethod
+    def _json_str(value: str) -> bytes:
+        """Encode a string as a JSON string literal for splicing into a template."""
+        return json.dumps(value).encode("utf-8")
+
+    # Delays between reconnection attempts after kanata dropped the connection
+    _RECONNECT_DELAYS = (0.1, 0.2, 0.4, 0.8, 1.6)
 
-            # Send a dummy command to avoid the server doesn't error if the client
-            # closes without sending anything
-            self.get_current_layer_name()
+    def _open(self):
+        log.debug("Connecting to %s:%s", *self.addr)
+        self._client.connect(self.addr)
+        self._client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._client.settimeout(0.5)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._client, selectors.EVENT_READ)
+        self._connected = True
+        self._layer_names = None  # may differ on a (re)started server
+        self._flush_buffer()  # Anything the server sent on connect
+
+        # Send a dummy command to avoid the server doesn't error if the client
+        # closes without sending anything
+        self.get_current_layer_name()
 
+    def _connect(self):
+        self._opening = True
+        try:
+            self._open()
         except socket.error as e:
             ip, port = self.addr
             fatal(
@@ -193,6 +482,8 @@ class Kanata:
                 ip,
                 port,
             )
+        finally:
+            self._opening = False
 
     def close(self):
         """Close the client socket connection gracefully."""
@@ -202,81 +493,205 @@ class Kanata:
                 self._client.shutdown(socket.SHUT_RDWR)
             except OSError:
                 pass  # Socket may already be closed or unconnected
-            self._client.close()
+            self._drop_socket()
 
-    def _flush_buffer(self):
+    def _drop_socket(self):
+        if self._selector is not None:
+            self._selector.close()
+            self._selector = None
+        self._client.close()
+        self._connected = False
+
+    def _reconnect(self):
+        """Replace a connection kanata closed, e.g. after it was restarted."""
+        self._drop_socket()
+        self._buffer.clear()
+        for delay in self._RECONNECT_DELAYS:
+            sleep(delay)
+            self._client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._opening = True
+            try:
+                self._open()
+                return
+            except OSError as e:
+                log.warning("Reconnecting to kanata failed: %s", e)
+                self._drop_socket()
+            finally:
+                self._opening = False
+        self._client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._connect()  # last attempt, fatal on failure
+
+    def _sync(self):
         """
-        Flushes any stale complete messages from the socket buffer before
-        sending a new command.
+        Connect, or handle what kanata sent since the last request. A connection
+        kanata closed in the meantime is replaced here, before anything is
+        written to it: the first write into a closed connection still succeeds.
         """
-        self._client.settimeout(0.01)
+        if not self._connected:
+            self._connect()
+            return
         try:
-            while True:
-                chunk = self._client.recv(1024)
-                if not chunk:
-                    break
-                self._buffer += chunk.decode("utf-8")
-        except socket.timeout:
-            pass
+            self._flush_buffer()
+        except ConnectionResetError as e:
+            if self._opening:
+                raise  # let _connect or _reconnect handle it
+            log.warning("Lost connection to kanata (%s), reconnecting", e)
+            self._reconnect()
 
-        if "\n" in self._buffer:
-            parts = self._buffer.split("\n")
-            self._buffer = parts[-1]  # Keep only last incomplete piece
+    def _flush_buffer(self):
+        """
+        Handle messages kanata sent on its own (e.g. `LayerChange`) without
+        waiting for more.
+        """
+        while self._read(0):
+            pass
 
-    def send(self, cmd: dict) -> Optional[str]:
-        if not self._connected:
-            self._connect()
-        logging.debug("Sending command: %s", cmd)
-        msg = json.dumps(cmd) + "\n"
+        for message in self._pop_messages():
+            self._track_layer(message)
 
-        self._flush_buffer()  # Discard old responses
-        self._client.sendall(msg.encode("utf-8"))
-        self._client.settimeout(0.05)
+    def _read(self, timeout: float) -> bool:
+        """
+        Wait up to `timeout` seconds for data and append it to the buffer.
+        Returns False if nothing arrived; raises ConnectionResetError if the
+        server closed the connection.
+        """
+        if not self._selector.select(timeout):
+            return False
+        n = self._client.recv_into(self._chunk)
+        if n == 0:
+            raise ConnectionResetError("connection closed by kanata")
+        self._buffer += self._chunk[:n]
+        return True
 
+    def _pop_messages(self) -> list[Dict[str, Any]]:
+        """
+        Decode all complete messages from the buffer, keeping only the last
+        incomplete piece. Messages are parsed in place with `raw_decode` rather
+        than splitting the buffer into lines first.
+        """
+        end = self._buffer.rfind(b"\n")
+        if end == -1:
+            return []
+        text = self._buffer[:end].decode("utf-8", "replace")
+        del self._buffer[: end + 1]
+
+        messages = []
+        idx = _JSON_WS_RE.match(text).end()
+        while idx < len(text):
+            try:
+                message, idx = self._decoder.raw_decode(text, idx)
+            except json.JSONDecodeError:
+                nl = text.find("\n", idx)
+                if nl == -1:
+                    nl = len(text)
+                log.debug("Ignoring malformed message: %s", text[idx:nl])
+                idx = nl + 1
+            else:
+                if isinstance(message, dict):
+                    messages.append(message)
+            idx = _JSON_WS_RE.match(text, idx).end()
+        return messages
+
+    def _track_layer(self, message: Dict[str, Any]) -> None:
+        """Update the cached layer from a `LayerChange` message sent by kanata."""
+        new_layer = message.get("LayerChange", {}).get("new")
+        if new_layer:
+            self._current_layer = new_layer
+
+    def send(self, msg: bytes, expect: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Send a newline-terminated JSON message. If `expect` is given, read until
+        the response carrying that key arrives and return it. Messages read on
+        the way are handled too, so no stale data is left for the next request.
+        """
+        self._sync()
+        logging.debug("Sending command: %s", msg)
         try:
-            while "\n" not in self._buffer:
-                chunk = self._client.recv(1024)
-                if not chunk:
-                    break
-                self._buffer += chunk.decode("utf-8")
-        except socket.timeout:
-            return None
-
-        lines = self._buffer.split("\n")
-        self._buffer = lines[-1]  # Save incomplete part
+            self._client.sendall(msg)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            if self._opening:
+                raise  # dropped again while connecting, let _reconnect retry
+            log.warning("Lost connection to kanata (%s), reconnecting", e)
+            self._reconnect()
+            self._client.sendall(msg)
+
+        if expect is None:
+            return {}
+
+        response = None
+        while response is None:
+            try:
+                if not self._read(0.05):
+                    return {}  # No response in time
+            except ConnectionResetError:
+                if self._opening:
+                    raise
+                log.warning("Kanata closed the connection before responding")
+                self._reconnect()
+                return {}
+            for message in self._pop_messages():  # Save incomplete part
+                self._track_layer(message)
+                if response is None and expect in message:
+                    response = message
 
-        for line in lines[:-1]:
-            if line.strip():
-                logging.debug("Received response line: %s", line.strip())
-                return line.strip()
+        logging.debug("Received response: %s", response)
+        return response
 
-        return None
+    def send_batch(self, messages: list[bytes]) -> None:
+        """Send several requests that expect no response with a single write."""
+        self.send(b"".join(messages))
 
     def get_current_layer_name(self) -> str:
-        data = self._parse_json_response(self.send({"RequestCurrentLayerName": {}}))
-        return data.get("CurrentLayerName", {}).get("name")
+        data = self.send(self._MSG_CURRENT_LAYER_NAME, "CurrentLayerName")
+        name = data.get("CurrentLayerName", {}).get("name")
+        if name:
+            self._current_layer = name
+        return name
 
     def get_current_layer_info(self) -> Optional[Dict[str, str]]:
-        data = self._parse_json_response(self.send({"RequestCurrentLayerInfo": {}}))
+        data = self.send(self._MSG_CURRENT_LAYER_INFO, "CurrentLayerInfo")
         return data.get("CurrentLayerInfo")
 
     def get_layer_names(self) -> list[str]:
-        data = self._parse_json_response(self.send({"RequestLayerNames": {}}))
-        return data.get("LayerNames", {}).get("names")
+        if self._layer_names is None:
+            data = self.send(self._MSG_LAYER_NAMES, "LayerNames")
+            self._layer_names = data.get("LayerNames", {}).get("names")
+        return self._layer_names
 
-    def change_layer(self, layer: str) -> bool:
-        if layer == self.get_current_layer_name():
+    def change_layer(self, layer: str, *follow_up: bytes) -> bool:
+        """
+        Switch to `layer` unless it is already active. `follow_up` requests (see
+        `fake_key_msg` and `set_mouse_msg`) are sent in the same write, and only
+        if the layer was switched.
+        """
+        # Also picks up layer changes made outside hyprkan, and fetches the
+        # current layer on a new connection
+        self._sync()
+
+        if layer == self._current_layer:
             log.debug("Layer '%s' is already active.", layer)
             return False
-        self._parse_json_response(self.send({"ChangeLayer": {"new": layer}}))
+        try:
+            self.send_batch(
+                [self._TPL_CHANGE_LAYER % self._json_str(layer), *follow_up]
+            )
+        except OSError:
+            self._current_layer = None  # unknown until kanata reports it again
+            raise
+        self._current_layer = layer
         log.info("Switched to layer '%s'", layer)
         return True
 
-    def act_on_fake_key(self, fake_key: tuple[str, str]) -> None:
+    def fake_key_msg(self, fake_key: tuple[str, str]) -> bytes:
         name, action = utils.validate_fake_key(fake_key, rule_no=None)
-        self._parse_json_response(
-            self.send({"ActOnFakeKey": {"name": name, "action": action}})
-        )
+        return self._TPL_FAKE_KEY % (self._json_str(name), self._json_str(action))
+
+    def set_mouse_msg(self, pos: tuple[int, int]) -> bytes:
+        x, y = pos
+        return self._TPL_SET_MOUSE % (x, y)
+
+    def act_on_fake_key(self, fake_key: tuple[str, str]) -> None:
+        self.send(self.fake_key_msg(fake_key))
 
     def set_mouse(self, pos: tuple[int, int]) -> None:
         """
@@ -285,98 +700,154 @@ class Kanata:
         ⚠️ This command is not supported on Linux as of Kanata v1.8.1.
         This method exists as a placeholder for future support.
         """
-        x, y = pos
-        self._parse_json_response(self.send({"SetMouse": {"x": x, "y": y}}))
+        self.send(self.set_mouse_msg(pos))
 
-    def _parse_json_response(self, response: Optional[str]) -> Dict[str, Any]:
-        if response:
-            try:
-                return json.loads(response)
-            except json.JSONDecodeError:
-                return {}
-        return {}
 
+@dataclass
+class _CompiledRule:
+    """A config rule together with its precomputed class/title matchers."""
+
+    __slots__ = ("index", "match_class", "match_title", "rule")
+
+    index: int  # position in the config; earlier rules win
+    match_class: Matcher
+    match_title: Matcher
+    rule: Rule
+
+    def matches_class(self, cls: str) -> bool:
+        return self._match(self.match_class, cls)
+
+    def matches(self, cls: str, title: str) -> bool:
+        return self._match(self.match_class, cls) and self._match(
+            self.match_title, title
+        )
 
-# pylint: disable=too-few-public-methods
+    @staticmethod
+    def _match(matcher: Matcher, value: str) -> bool:
+        kind, arg = matcher
+        if kind == _MATCH_ANY:
+            return True
+        if kind == _MATCH_CONTAINS:
+            return arg in value
+        if kind == _MATCH_EQUALS:
+            return value == arg
+        if kind == _MATCH_PREFIX:
+            return value.startswith(arg)
+        if kind == _MATCH_SUFFIX:
+            return value.endswith(arg)
+        return arg.search(value) is not None
+
+
+# pylint: disable=too-few-public-methods,too-many-instance-attributes
 class Config:
     """Load and validate data configuration from a JSON file."""
 
-    def __init__(self, path: str, kanata: Kanata):
-        self._path = path
+    _MATCH_CACHE_SIZE = 256
+
+    def __init__(
+        self, source: Union[str, os.PathLike, bytes, bytearray], kanata: Kanata
+    ):
+        """`source` is the path of the config file, or its JSON content as bytes."""
+        if isinstance(source, (bytes, bytearray)):
+            self._path = "<bytes>"
+            self._payload: Optional[Union[bytes, bytearray]] = source
+        else:
+            self._path = os.fspath(source)
+            self._payload = None
         self._kanata = kanata
         self.rules = self._load()
-        self._validate()
+        self._compiled = self._compile()
+        self._validate_layers()
+        log.info("Configuration at '%s' is valid.", self._path)
+        self._by_class, self._unindexed = self._build_index()
+        self._candidates, self._class_only = self._merge_buckets()
+        self._bucket_res = self._combine_buckets()
+        # Focus usually moves between a handful of windows; built per instance so the cache
+        # can never outlive the rules it was filled from.
+        self._match_cached = functools.lru_cache(maxsize=self._MATCH_CACHE_SIZE)(
+            self._match_rule
+        )
 
-    def _load(self) -> list[Rule]:
-        if os.path.exists(self._path):
-            try:
-                with open(self._path, "r", encoding="utf-8") as file:
-                    log.info("Loaded configuration file from '%s'", self._path)
-                    return json.load(file)
-            except json.JSONDecodeError as e:
-                fatal("Failed to decode JSON from '%s': %s", self._path, e)
-        else:
-            fatal("Configuration file not found: %s", self._path)
+    def _load(self) -> list[RuleDict]:
+        try:
+            # pylint: disable=import-outside-toplevel
+            from orjson import loads  # optional, faster config parsing
+        except ImportError:
+            loads = json.loads
 
-    def _validate(self) -> None:
-        if not isinstance(self.rules, list):
-            fatal("Invalid config format: expected an array.")
-        allowed_rule_keys = {"class", "title", "layer", "fake_key", "set_mouse", "cmd"}
-        kanata_layers = self._kanata.get_layer_names()
+        data = self._payload
+        if data is None:
+            if not os.path.exists(self._path):
+                fatal("Configuration file not found: %s", self._path)
+            with open(self._path, "rb") as file:
+                data = file.read()
+            log.info("Loaded configuration file from '%s'", self._path)
+
+        try:
+            return loads(data)
+        except ValueError as e:  # JSONDecodeError, UnicodeDecodeError
+            fatal("Failed to decode JSON from '%s': %s", self._path, e)
 
-        for i, rule in enumerate(self.rules):
-            rule_no = i + 1
-            rule_fake_key = rule.get("fake_key")
-            rule_set_mouse = rule.get("set_mouse")
+    _ALLOWED_RULE_KEYS = ("class", "title", "layer", "fake_key", "set_mouse", "cmd")
 
-            unexpected_rule_keys = rule.keys() - allowed_rule_keys
-            if unexpected_rule_keys:
-                fatal(
-                    "Invalid config: rule #%d contains unexpected keys(s): %s. "
-                    "Allowed keys: [%s].",
-                    rule_no,
-                    ", ".join(unexpected_rule_keys),
-                    ", ".join(allowed_rule_keys),
-                )
+    def _validate_rule(self, rule: RuleDict, rule_no: int) -> None:
+        """Check the structure of a single rule; layers are checked separately."""
+        if not isinstance(rule, dict) or not rule:
+            fatal(
+                "Invalid config: rule #%d must be a non-empty JSON object "
+                "(key-value pairs).",
+                rule_no,
+            )
 
-            for key in ["class", "title", "layer", "cmd"]:
-                value = rule.get(key)
-                if value is False or value is None:
-                    continue
-                if not isinstance(value, str) or utils.is_blank(value):
-                    fatal(
-                        "Invalid config: key '%s' in rule #%d must be a non-empty "
-                        "string or set to false/null or be removed to disable it.",
-                        key,
-                        rule_no,
-                    )
+        unexpected_rule_keys = rule.keys() - self._ALLOWED_RULE_KEYS
+        if unexpected_rule_keys:
+            fatal(
+                "Invalid config: rule #%d contains unexpected keys(s): %s. "
+                "Allowed keys: [%s].",
+                rule_no,
+                ", ".join(unexpected_rule_keys),
+                ", ".join(self._ALLOWED_RULE_KEYS),
+            )
 
-            if not isinstance(rule, dict) or not rule:
+        for key in ["class", "title", "layer", "cmd"]:
+            value = rule.get(key)
+            if value is False or value is None:
+                continue
+            if not isinstance(value, str) or utils.is_blank(value):
                 fatal(
-                    "Invalid config: rule #%d must be a non-empty JSON object "
-                    "(key-value pairs).",
+                    "Invalid config: key '%s' in rule #%d must be a non-empty "
+                    "string or set to false/null or be removed to disable it.",
+                    key,
                     rule_no,
                 )
 
-            if rule_fake_key:
-                if not isinstance(rule_fake_key, list) or not all(
-                    isinstance(k, str) for k in rule_fake_key
-                ):
-                    fatal(
-                        "Invalid config: 'fake_key' in rule #%d must be an array of strings.",
-                        rule_no,
-                    )
-                utils.validate_fake_key(rule_fake_key, rule_no)
-
-            if rule_set_mouse and (
-                not isinstance(rule_set_mouse, list)
-                or not all(isinstance(k, int) for k in rule_set_mouse)
+        rule_fake_key = rule.get("fake_key")
+        if rule_fake_key:
+            if not isinstance(rule_fake_key, list) or not all(
+                isinstance(k, str) for k in rule_fake_key
             ):
                 fatal(
-                    "Invalid config: 'set_mouse' in rule #%d must be an array of integers.",
+                    "Invalid config: 'fake_key' in rule #%d must be an array of strings.",
                     rule_no,
                 )
+            utils.validate_fake_key(rule_fake_key, rule_no)
+
+        rule_set_mouse = rule.get("set_mouse")
+        if rule_set_mouse and (
+            not isinstance(rule_set_mouse, list)
+            or not all(isinstance(k, int) for k in rule_set_mouse)
+        ):
+            fatal(
+                "Invalid config: 'set_mouse' in rule #%d must be an array of integers.",
+                rule_no,
+            )
 
+    def _validate_layers(self) -> None:
+        if os.getenv("HYPRKAN_SKIP_LAYER_CHECK"):
+            return
+        kanata_layers = set(self._kanata.get_layer_names() or ())
+
+        for rule_no, rule in enumerate(self.rules, start=1):
             layer = rule.get("layer")
             if layer and layer not in kanata_layers:
                 fatal(
@@ -386,9 +857,137 @@ class Config:
                     rule_no,
                 )
 
-        log.info("Configuration at '%s' is valid.", self._path)
+    def _compile(self) -> list["_CompiledRule"]:
+        """
+        Validate every rule and precompute its class/title matchers, in a single
+        pass over the config.
+        """
+        if not isinstance(self.rules, list):
+            fatal("Invalid config format: expected an array.")
+
+        def to_matcher(key: str, rule: RuleDict, rule_no: int) -> Matcher:
+            value = rule.get(key)
+            if not value or value == "*":
+                return (_MATCH_ANY, None)
+
+            start = value.startswith("^")
+            end = value.endswith("$")
+            literal = value[start : len(value) - end]
+            # `$` also matches before a trailing newline, which window classes
+            # and titles never end with.
+            if literal and _REGEX_META.isdisjoint(literal):
+                if start and end:
+                    # Interned like incoming window classes (see `listen`), so the
+                    # bucket lookup and the comparison succeed on identity
+                    return (_MATCH_EQUALS, sys.intern(literal))
+                if start:
+                    return (_MATCH_PREFIX, literal)
+                if end:
+                    return (_MATCH_SUFFIX, literal)
+                return (_MATCH_CONTAINS, literal)
+
+            try:
+                return (_MATCH_REGEX, re.compile(value))
+            except re.error as e:
+                fatal(
+                    "Invalid config: key '%s' in rule #%d is not a valid regular "
+                    "expression: %s",
+                    key,
+                    rule_no,
+                    e,
+                )
+
+        compiled = []
+        for i, rule in enumerate(self.rules, start=1):
+            self._validate_rule(rule, i)
+            compiled.append(
+                _CompiledRule(
+                    i,
+                    to_matcher("class", rule, i),
+                    to_matcher("title", rule, i),
+                    Rule.from_dict(rule),
+                )
+            )
+        return compiled
+
+    def _build_index(
+        self,
+    ) -> Tuple[Dict[str, list[_CompiledRule]], list[_CompiledRule]]:
+        """
+        Bucket rules with an exact class (`^class$`) by that class, so a focus
+        event only evaluates the rules of its class plus the rules that can
+        match any class. Both lists stay in config order.
+        """
+        by_class: Dict[str, list[_CompiledRule]] = {}
+        unindexed: list[_CompiledRule] = []
+        for compiled in self._compiled:
+            kind, cls = compiled.match_class
+            if kind == _MATCH_EQUALS:
+                by_class.setdefault(cls, []).append(compiled)
+            else:
+                unindexed.append(compiled)
+        return by_class, unindexed
+
+    def _merge_buckets(
+        self,
+    ) -> Tuple[Dict[str, list[_CompiledRule]], Dict[str, Rule]]:
+        """
+        Merge each bucket with the rules not bound to an exact class, once
+        instead of on every event. The class is known per bucket, so rules
+        whose class can't match it are dropped up front.
 
-    def detect_rule(self, win_info) -> Optional[Rule]:
+        Also returns the rule of every class whose first candidate matches any
+        title; such windows resolve without looking at the title at all.
+        """
+        candidates: Dict[str, list[_CompiledRule]] = {}
+        class_only: Dict[str, Rule] = {}
+        for cls, bucket in self._by_class.items():
+            merged = [
+                compiled
+                for compiled in heapq.merge(
+                    bucket, self._unindexed, key=attrgetter("index")
+                )
+                if compiled.matches_class(cls)
+            ]
+            candidates[cls] = merged
+            if merged[0].match_title[0] == _MATCH_ANY:
+                class_only[cls] = merged[0].rule
+        return candidates, class_only
+
+    def _combine_buckets(self) -> Dict[str, re.Pattern]:
+        """
+        Join the title patterns of each class bucket into a single regex, so the
+        bucket is resolved by one match call instead of one per rule.
+
+        Every alternative is anchored at the start and scans ahead lazily itself,
+        so the regex engine tries them in config order and the first rule whose
+        pattern matches anywhere in the title wins, exactly as with search().
+        Buckets containing a pattern that uses groups or inline flags keep being
+        evaluated rule by rule.
+        """
+        combined: Dict[str, re.Pattern] = {}
+        for cls, bucket in self._by_class.items():
+            if len(bucket) < 2:
+                continue
+            alternatives = []
+            for compiled in bucket:
+                kind, arg = compiled.match_title
+                if kind == _MATCH_ANY:
+                    pattern = ""
+                elif kind == _MATCH_REGEX:
+                    if arg.groups or arg.flags != re.UNICODE:
+                        break
+                    pattern = arg.pattern
+                else:
+                    pattern = compiled.rule.title
+                # Only the lazy prefix may cross newlines; `.` in the user's pattern
+                # keeps its meaning
+                alternatives.append(f"(?P<r{len(alternatives)}>(?s:.*?)(?:{pattern}))")
+            else:
+                combined[cls] = re.compile("|".join(alternatives))
+        return combined
+
+    def detect_rule(self, win_info: WinInfo) -> Optional[Rule]:
         """
         Resolve the appropriate rule based on active window information.
 
@@ -396,31 +995,71 @@ class Config:
         If a rule matches, it is returned. If no rules match, None is returned.
         """
 
-        current_win_class = win_info.get("cls", "*")
-        current_win_title = win_info.get("title", "*")
-
-        def to_pattern(value):
-            return f".*{value}.*" if value != "*" else ".*"
-
-        for rule in self.rules:
-            pattern_class = to_pattern(rule.get("class", "*"))
-            pattern_title = to_pattern(rule.get("title", "*"))
-            log.debug(
-                "Evaluating rule: %s | Current window: {'class':'%s', 'title':'%s'}",
-                rule,
+        return self._match_cached(win_info.cls, win_info.title)
+
+    def _match_rule(
+        self, current_win_class: str, current_win_title: str
+    ) -> Optional[Rule]:
+        """Return the first rule matching the window class and title."""
+        # Resolve everything that doesn't depend on the rule once per event
+        debug = log.isEnabledFor(logging.DEBUG)
+
+        rule = self._class_only.get(current_win_class)
+        if rule is not None:
+            log.debug("Matching rule found by class alone: %s", rule)
+            return rule
+
+        bucket_re = self._bucket_res.get(current_win_class)
+        if bucket_re is not None:
+            return self._match_combined(
+                self._by_class[current_win_class],
+                bucket_re,
                 current_win_class,
                 current_win_title,
             )
 
-            if re.match(pattern_class, current_win_class) and re.match(
-                pattern_title, current_win_title
-            ):
+        for compiled in self._candidates.get(current_win_class, self._unindexed):
+            rule = compiled.rule
+            if debug:
+                log.debug(
+                    "Evaluating rule: %s | Current window: {'class':'%s', 'title':'%s'}",
+                    rule,
+                    current_win_class,
+                    current_win_title,
+                )
+
+            if compiled.matches(current_win_class, current_win_title):
                 log.debug("Matching rule found: %s", rule)
                 return rule
 
         log.debug("No matching rule found.")
         return None
 
+    def _match_combined(
+        self,
+        bucket: list[_CompiledRule],
+        bucket_re: re.Pattern,
+        current_win_class: str,
+        current_win_title: str,
+    ) -> Optional[Rule]:
+        """Resolve a combined bucket, then let earlier any-class rules take precedence."""
+        m = bucket_re.match(current_win_title)
+        hit = bucket[int(m.lastgroup[1:])] if m else None
+        limit = hit.index if hit else sys.maxsize
+
+        for compiled in self._unindexed:
+            if compiled.index > limit:
+                break
+            if compiled.matches(current_win_class, current_win_title):
+                log.debug("Matching rule found: %s", compiled.rule)
+                return compiled.rule
+
+        if hit:
+            log.debug("Matching rule found: %s", hit.rule)
+            return hit.rule
+        log.debug("No matching rule found.")
+        return None
+
 
 class BaseWM:
     """Base class for window manager/compositor implementations."""
@@ -439,46 +1078,46 @@ class WMBaseListener(BaseWM):
     def listen(self, kanata: Kanata, cfg: Config):
         """Start listening for window focus changes and manage Kanata layer switching."""
 
-        last_win_title = None
-        last_win_class = None
+        last_win: Optional[WinInfo] = None
 
-        def on_focus_event():
-            nonlocal last_win_title, last_win_class
-            win_info = self.get_active_win()
-            active_win_class = win_info["cls"]
-            active_win_title = win_info["title"]
+        def on_focus_event(win_info: Optional[WinInfo] = None):
+            nonlocal last_win
+            if win_info is None:
+                win_info = self.get_active_win()
+            # Few distinct classes, seen over and over
+            win_info = WinInfo(sys.intern(win_info.cls), win_info.title)
 
-            if active_win_title != last_win_title or active_win_class != last_win_class:
-                log.info(
-                    "current_win: {'class':'%s', 'title':'%s'}",
-                    active_win_class,
-                    active_win_title,
-                )
-                matched_rule = cfg.detect_rule(win_info)
-
-                if matched_rule:
-                    last_win_title = active_win_title
-                    last_win_class = active_win_class
-                    rule_layer = matched_rule.get("layer")
-
-                    if not rule_layer:
-                        return
-                    ok = kanata.change_layer(rule_layer)
-
-                    if ok:
-                        rule_cmd = matched_rule.get("cmd")
-                        fake_key = matched_rule.get("fake_key")
-                        set_mouse = matched_rule.get("set_mouse")
-                        if rule_cmd:
-                            utils.run_cmd_bg(rule_cmd)
-                        if fake_key:
-                            kanata.act_on_fake_key(fake_key)
-                        if set_mouse:
-                            kanata.set_mouse(set_mouse)
+            # Focus events often repeat for the same window (e.g. workspace switches)
+            if win_info == last_win:
+                return
+            last_win = win_info
+
+            log.info("current_win: {'class':'%s', 'title':'%s'}", *win_info)
+            matched_rule = cfg.detect_rule(win_info)
+
+            if matched_rule:
+                rule_layer = matched_rule.layer
+
+                if not rule_layer:
+                    return
+                follow_up = []
+                if matched_rule.fake_key:
+                    follow_up.append(kanata.fake_key_msg(matched_rule.fake_key))
+                if matched_rule.set_mouse:
+                    follow_up.append(kanata.set_mouse_msg(matched_rule.set_mouse))
+                ok = kanata.change_layer(rule_layer, *follow_up)
+
+                if ok and matched_rule.cmd:
+                    utils.run_cmd_bg(matched_rule.cmd)
 
         self._setup_event_listener(on_focus_event)
 
     def _setup_event_listener(self, on_focus_callback):
+        """
+        Call `on_focus_callback` on every focus change. Listeners that already
+        know the focused window from the event may pass it as a `WinInfo`,
+        otherwise `get_active_win` is queried.
+        """
         raise NotImplementedError("Implement in subclass")
 
 
@@ -488,36 +1127,39 @@ class Hyprland(WMBaseListener):
     and change Kanata layers.
     """
 
+    _REQUEST_TIMEOUT = 1.0  # seconds
+
     def __init__(self):
-        self._soc = self._get_soc()
-        self._soc2 = self._get_soc2()
+        base = self._get_soc_dir()
+        self._soc = str(base / ".socket.sock")
+        self._soc2 = str(base / ".socket2.sock")
         self._validate_sockets()
 
-    def _get_soc(self) -> str:
-        runtime_dir = utils.require_env("XDG_RUNTIME_DIR")
-        instance_sig = utils.require_env("HYPRLAND_INSTANCE_SIGNATURE")
-        return f"{runtime_dir}/hypr/{instance_sig}/.socket.sock"
-
-    def _get_soc2(self) -> str:
+    @staticmethod
+    def _get_soc_dir() -> Path:
+        """Return the directory holding the sockets of this Hyprland instance."""
         runtime_dir = utils.require_env("XDG_RUNTIME_DIR")
         instance_sig = utils.require_env("HYPRLAND_INSTANCE_SIGNATURE")
-        return f"{runtime_dir}/hypr/{instance_sig}/.socket2.sock"
+        return Path(runtime_dir) / "hypr" / instance_sig
 
     def _validate_sockets(self):
-        """Ensure both Hyprland socket paths exist."""
+        """Ensure both Hyprland socket paths exist and are sockets."""
         for path in [self._soc, self._soc2]:
-            if not os.path.exists(path):
+            try:
+                mode = os.stat(path).st_mode
+            except OSError:
                 fatal("Hyprland socket not found at %s", path)
+            if not stat.S_ISSOCK(mode):
+                fatal("Hyprland socket path is not a socket: %s", path)
             log.debug("Hyprland socket path is valid: %s", path)
 
     def get_active_win(self) -> WinInfo:
         """Fetch class and title of the active window via Hyprland's JSON IPC."""
-        log.debug("Connecting to socket at %s", self._soc)
-
-        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
-            sock.connect(self._soc)
-            sock.send(b"j/activewindow")
-            response = sock.recv(4096).decode("utf-8")
+        try:
+            response = self._request(b"j/activewindow").decode("utf-8", "replace")
+        except OSError as e:
+            log.warning("Failed to query Hyprland at %s: %s", self._soc, e)
+            return WinInfo("*", "*")
 
         log.debug("Received response: %s", response)
 
@@ -525,12 +1167,35 @@ class Hyprland(WMBaseListener):
             win_info = json.loads(response)
         except json.JSONDecodeError:
             log.warning("Failed to parse JSON from socket: %s", response)
-            return {"cls": "*", "title": "*"}
+            return WinInfo("*", "*")
 
-        return {
-            "cls": win_info.get("class", "*"),
-            "title": win_info.get("title", "*"),
-        }
+        return WinInfo(win_info.get("class", "*"), win_info.get("title", "*"))
+
+    def _request(self, cmd: bytes) -> bytes:
+        """
+        Send a single command over Hyprland's request socket (socket1).
+
+        Hyprland serves one command per connection and closes it after
+        replying, so the connection can't be kept open. A compositor that
+        doesn't answer in time fails the request instead of hanging hyprkan.
+        """
+        log.debug("Connecting to socket at %s", self._soc)
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self._REQUEST_TIMEOUT)
+            sock.connect(self._soc)
+            sock.sendall(cmd)
+            # The reply can exceed a single recv (e.g. long titles)
+            return bytes(utils.recv_until_eof(sock))
+
+    @staticmethod
+    def _parse_active_window(payload: str) -> Optional[WinInfo]:
+        """Parse the `WINDOWCLASS,WINDOWTITLE` payload of an `activewindow` event."""
+        cls, sep, title = payload.partition(",")
+        if not sep:
+            log.debug("Unexpected activewindow payload: %s", payload)
+            return None
+        return WinInfo(cls or "*", title or "*")
 
     def _setup_event_listener(self, on_focus_callback):
         log.debug("Listening for Hyprland events on socket: %s", self._soc2)
@@ -538,11 +1203,17 @@ class Hyprland(WMBaseListener):
         try:
             with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
                 sock.connect(self._soc2)
-                sock_file = sock.makefile("r")
-                for line in sock_file:
-                    event = line.strip()
-                    if event.startswith("activewindow>>"):
-                        on_focus_callback()
+                buf = bytearray()
+                prefix = b"activewindow>>"
+                while True:
+                    chunk = sock.recv(4096)
+                    if not chunk:
+                        break
+                    buf += chunk
+                    for event in utils.pop_lines(buf):
+                        if event.startswith(prefix):
+                            payload = event[len(prefix) :].decode("utf-8", "replace")
+                            on_focus_callback(self._parse_active_window(payload))
         except FileNotFoundError:
             fatal("Socket not found at: %s", self._soc2)
         except ConnectionRefusedError:
@@ -572,13 +1243,12 @@ class Niri(WMBaseListener):
             try:
                 data = json.loads(response)
                 focused = data["Ok"]["FocusedWindow"]
-                return {
-                    "cls": focused.get("app_id", "*"),
-                    "title": focused.get("title", "*"),
-                }
+                return WinInfo(
+                    focused.get("app_id") or "*", focused.get("title") or "*"
+                )
             except (KeyError, json.JSONDecodeError) as e:
                 log.warning("Failed to get focused window info: %s", e)
-                return {"cls": "*", "title": "*"}
+                return WinInfo("*", "*")
 
     def _setup_event_listener(self, on_focus_callback):
         log.debug("Listening for Niri events on socket: %s", self._soc)
@@ -625,11 +1295,11 @@ class Sway(WMBaseListener):
     def get_active_win(self) -> WinInfo:
         focused = self.ipc.get_tree().find_focused()
         if not focused:
-            return {"cls": "*", "title": "*"}
-        return {
-            "cls": focused.app_id or focused.window_class or "*",
-            "title": focused.name or "*",  # type: ignore
-        }
+            return WinInfo("*", "*")
+        return WinInfo(
+            focused.app_id or focused.window_class or "*",
+            focused.name or "*",  # type: ignore
+        )
 
     def _setup_event_listener(self, on_focus_callback):
         def handler(_ipc, _event):
@@ -694,7 +1364,7 @@ class X11(WMBaseListener):
                 self.atoms.NET_ACTIVE_WINDOW, self.X.AnyPropertyType
             )
             if not window_id_prop or not window_id_prop.value:
-                return {"cls": "*", "title": "*"}
+                return WinInfo("*", "*")
             window_id = window_id_prop.value[0]
             window = self.disp.create_resource_object("window", window_id)
 
@@ -712,7 +1382,7 @@ class X11(WMBaseListener):
                 if len(class_data) >= 2:
                     cls = class_data[1]
 
-            return {"cls": cls, "title": title}
+            return WinInfo(cls, title)
         except (
             self.errors["DisplayError"],
             self.errors["XError"],
@@ -720,19 +1390,30 @@ class X11(WMBaseListener):
             IndexError,
         ) as e:
             log.warning("Failed to get active window info: %s", e)
-            return WinInfo(cls="*", title="*")
+            return WinInfo("*", "*")
 
     def _setup_event_listener(self, on_focus_callback):
         self.root.change_attributes(event_mask=self.X.PropertyChangeMask)
         self.disp.flush()
 
+        fd = self.disp.fileno()
         while True:
             try:
-                event = self.disp.next_event()
-                if (
-                    event.type == self.X.PropertyNotify
-                    and event.atom == self.atoms.NET_ACTIVE_WINDOW
-                ):
+                # Sleep until the X server has something for us, then drain the
+                # whole burst and react at most once to it.
+                if not self.disp.pending_events():
+                    select.select([fd], [], [])
+
+                active_window_changed = False
+                while self.disp.pending_events():
+                    event = self.disp.next_event()
+                    if (
+                        event.type == self.X.PropertyNotify
+                        and event.atom == self.atoms.NET_ACTIVE_WINDOW
+                    ):
+                        active_window_changed = True
+
+                if active_window_changed:
                     window_id_prop = self.root.get_full_property(
                         self.atoms.NET_ACTIVE_WINDOW, self.X.AnyPropertyType
                     )
@@ -819,7 +1500,7 @@ class ColorFormatter(logging.Formatter):
 
 
 def config_logger(
-    ll: Literal["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"] = "INFO"
+    ll: Literal["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"] = "INFO",
 ):
     """Configure the logger to output to stdout with optional color if attached to a terminal."""
 
@@ -861,6 +1542,7 @@ def setup_signals(kanata):
         name = signal.Signals(signum).name
         log.warning("Received signal %s. Exiting gracefully...", name)
         kanata.close()
+        utils.stop_cmds()
         sys.exit(1)
 
     signal.signal(signal.SIGINT, handle_signal)  # Ctrl+C
@@ -979,7 +1661,7 @@ def handle_cli_commands(args, kanata, session) -> bool:
         print(kanata.get_current_layer_info())
     elif args.current_window_info is not None:
         sleep(args.current_window_info)
-        print(session.get_active_window())
+        print(session.get_active_window()._asdict())
     else:
         return False
     return True
@@ -993,13 +1675,13 @@ def main():
 
     session = Session()
     kanata = Kanata(args.port)
-    cfg = Config(args.config, kanata)
 
     setup_signals(kanata)
 
     if handle_cli_commands(args, kanata, session):
-        return
+        return  # one-off commands don't need the config
 
+    cfg = Config(args.config, kanata)
     session.wm.listen(kanata, cfg)
 
 
@@ -2,7 +2,7 @@ import json
 import tempfile
 from pathlib import Path
 import pytest
-from src.hyprkan import Config, Kanata
+from src.hyprkan import Config, Kanata, WinInfo
 
 VALID_CONFIG_PATH = Path(__file__).parent / "fixtures" / "valid_config.json"
 INVALID_CONFIG_PATH = Path(__file__).parent / "fixtures" / "invalid_configs.json"
@@ -39,12 +39,19 @@ def write_temp_config(rules: list[dict]) -> str:
         return tmp_file.name
 
 
+def encode_config(rules: list[dict]) -> bytes:
+    return json.dumps(rules).encode()
+
+
 def load_invalid_configs():
     path = INVALID_CONFIG_PATH
     with open(path, encoding="utf-8") as f:
         return json.load(f)
 
 
+INVALID_CONFIGS = load_invalid_configs()
+
+
 def load_rules_from_fixture() -> list[dict]:
     path = VALID_CONFIG_PATH
     with open(path, "r", encoding="utf-8") as f:
@@ -60,28 +67,50 @@ class TestConfigValidation:
         assert config.rules == rules
         assert "Configuration at" in caplog.text
 
-    @pytest.mark.parametrize("rules, error_msg", load_invalid_configs())
+    @pytest.mark.parametrize("rules, error_msg", INVALID_CONFIGS)
     def test_invalid_configs_fail(self, rules, error_msg, caplog):
-        path = write_temp_config(rules)
         with caplog.at_level("ERROR"), pytest.raises(SystemExit):
-            Config(path, DummyKanata(KANATA_LAYERS))
+            Config(encode_config(rules), DummyKanata(KANATA_LAYERS))
         assert error_msg in caplog.text
 
+    def test_malformed_json_fails(self, caplog):
+        with caplog.at_level("ERROR"), pytest.raises(SystemExit):
+            Config(b'[{"class": "kitty",]', DummyKanata(KANATA_LAYERS))
+        assert "Failed to decode JSON" in caplog.text
+
+    def test_skip_layer_check(self, monkeypatch):
+        monkeypatch.setenv("HYPRKAN_SKIP_LAYER_CHECK", "1")
+        rules = [{"class": "kitty", "layer": "nonexistent"}]
+        config = Config(encode_config(rules), DummyKanata([]))
+        assert config.rules == rules
+
+    def test_bytes_payload_is_loaded(self, caplog):
+        rules = [{"class": "kitty", "layer": "media"}]
+        with caplog.at_level("INFO"):
+            config = Config(encode_config(rules), DummyKanata(KANATA_LAYERS))
+        assert config.rules == rules
+        assert "Configuration at '<bytes>' is valid" in caplog.text
+
 
 class TestRuleMatching:
+    @pytest.fixture(scope="class")
+    @classmethod
+    def config(cls):
+        return Config(str(VALID_CONFIG_PATH), DummyKanata(KANATA_LAYERS))
+
     @pytest.mark.parametrize(
         "win_info, expected_rule",
         [
             (
-                {"cls": "chrome", "title": "YouTube"},
+                WinInfo("chrome", "YouTube"),
                 {"class": "chrome", "title": "YouTube", "layer": "media"},
             ),
             (
-                {"cls": "code-oss", "title": "index.html - Code - OSS"},
+                WinInfo("code-oss", "index.html - Code - OSS"),
                 {"class": "code-oss", "title": "*", "layer": "vs_code"},
             ),
             (
-                {"cls": "vlc", "title": "Movie"},
+                WinInfo("vlc", "Movie"),
                 {
                     "class": "vlc",
                     "title": "Movie",
@@ -91,7 +120,7 @@ class TestRuleMatching:
                 },
             ),
             (
-                {"cls": "nvim", "title": "nvim - [Scratch]"},
+                WinInfo("nvim", "nvim - [Scratch]"),
                 {
                     "class": "nvim",
                     "title": "nvim - \\[Scratch]",
@@ -99,31 +128,141 @@ class TestRuleMatching:
                 },
             ),
             (
-                {"cls": "Steam", "title": "Library"},
+                WinInfo("Steam", "Library"),
                 {"class": "Steam", "title": "Library", "layer": "gaming"},
             ),
             (
-                {"cls": "obs", "title": "Recording"},
+                WinInfo("obs", "Recording"),
                 {"class": "^obs$", "layer": "streaming"},
             ),
             (
-                {"cls": "random", "title": "ChatGPT"},
+                WinInfo("random", "ChatGPT"),
                 {"class": "*", "title": "ChatGPT", "layer": "ai_layer"},
             ),
             (
-                {"cls": "any", "title": "README.md"},
+                WinInfo("any", "README.md"),
                 {"title": "README", "layer": "docs"},
             ),
             (
-                {"cls": "something", "title": "unknown"},
+                WinInfo("kitty", "vim - main.c"),
+                {"class": "^kitty$", "title": "^vim", "layer": "shell"},
+            ),
+            (
+                WinInfo("kitty", "vim - ChatGPT"),
+                {"class": "*", "title": "ChatGPT", "layer": "ai_layer"},
+            ),
+            (
+                WinInfo("kitty-2", "vim"),
+                {"class": "*", "title": "*", "layer": "base_layer"},
+            ),
+            (
+                WinInfo("kitty", "nvim"),
+                {"class": "*", "title": "*", "layer": "base_layer"},
+            ),
+            (
+                WinInfo("gedit", "Todo - Notes"),
+                {"title": "- Notes$", "layer": "docs"},
+            ),
+            (
+                WinInfo("gedit", "Todo - Notes (2)"),
                 {"class": "*", "title": "*", "layer": "base_layer"},
             ),
+            (
+                WinInfo("something", "unknown"),
+                {"class": "*", "title": "*", "layer": "base_layer"},
+            ),
+        ],
+    )
+    def test_detect_rule_matches(self, config, win_info, expected_rule):
+        assert config.detect_rule(win_info).as_dict() == expected_rule
+
+    def test_detected_rule_is_hashable(self, config):
+        rule = config.detect_rule(WinInfo("vlc", "Movie"))
+        assert rule.fake_key == ("Space", "Tap")
+        assert rule.set_mouse == (300, 400)
+        assert {rule: rule.layer}[rule] == "media"
+
+    def test_detect_rule_cache_is_bounded(self):
+        config = Config(str(VALID_CONFIG_PATH), DummyKanata(KANATA_LAYERS))
+        first = config.detect_rule(WinInfo("chrome", "YouTube"))
+        assert config.detect_rule(WinInfo("chrome", "YouTube")) is first
+
+        for i in range(Config._MATCH_CACHE_SIZE * 2):
+            config.detect_rule(WinInfo(f"app{i}", "*"))
+        assert config._match_cached.cache_info().currsize == Config._MATCH_CACHE_SIZE
+
+        misses = config._match_cached.cache_info().misses
+        config.detect_rule(WinInfo("chrome", "YouTube"))
+        assert config._match_cached.cache_info().misses == misses + 1
+
+    @pytest.mark.parametrize(
+        "win_info, expected_layer",
+        [
+            (WinInfo("firefox", "YouTube - Mozilla Firefox"), "media"),
+            (WinInfo("firefox", "Private Browsing"), "chat"),
+            (WinInfo("firefox", "GitHub Private repo"), "dev"),
+            (WinInfo("firefox", "Jira - Backlog"), "docs"),
+            (WinInfo("firefox", "Jira - Roadmap"), "base_layer"),
+            (WinInfo("chrome", "YouTube"), None),
         ],
     )
-    def test_detect_rule_matches(self, win_info, expected_rule):
-        valid_config_path = VALID_CONFIG_PATH
-        config = Config(
-            str(valid_config_path),
-            DummyKanata(KANATA_LAYERS),
-        )
-        assert config.detect_rule(win_info) == expected_rule
+    def test_combined_bucket_matches_in_config_order(self, win_info, expected_layer):
+        rules = [
+            {"class": "^firefox$", "title": "YouTube", "layer": "media"},
+            {"class": "^firefox$", "title": "^GitHub", "layer": "dev"},
+            {"title": "Private", "layer": "chat"},
+            {
+                "class": "^firefox$",
+                "title": "Jira - (?:Board|Backlog)$",
+                "layer": "docs",
+            },
+            {"class": "^firefox$", "layer": "base_layer"},
+        ]
+        config = Config(encode_config(rules), DummyKanata(KANATA_LAYERS))
+        assert "firefox" in config._bucket_res
+        rule = config.detect_rule(win_info)
+        assert (rule and rule.layer) == expected_layer
+
+    @pytest.mark.parametrize(
+        "title, expected_layer",
+        [("a\nb", "dev"), ("x\na-b", "media")],
+    )
+    def test_combined_bucket_keeps_dot_semantics(self, title, expected_layer):
+        rules = [
+            {"class": "^firefox$", "title": "a.b", "layer": "media"},
+            {"class": "^firefox$", "title": "*", "layer": "dev"},
+        ]
+        config = Config(encode_config(rules), DummyKanata(KANATA_LAYERS))
+        assert "firefox" in config._bucket_res
+        assert config.detect_rule(WinInfo("firefox", title)).layer == expected_layer
+
+    def test_bucket_with_groups_is_not_combined(self):
+        rules = [
+            {"class": "^firefox$", "title": "(a)\\1", "layer": "media"},
+            {"class": "^firefox$", "title": "YouTube", "layer": "dev"},
+        ]
+        config = Config(encode_config(rules), DummyKanata(KANATA_LAYERS))
+        assert "firefox" not in config._bucket_res
+        assert config.detect_rule(WinInfo("firefox", "aa")).layer == "media"
+
+    def test_class_only_bucket_resolves_without_title(self):
+        rules = [
+            {"class": "^obs$", "layer": "streaming"},
+            {"title": "Recording", "layer": "media"},
+        ]
+        config = Config(encode_config(rules), DummyKanata(KANATA_LAYERS))
+        assert config._class_only["obs"].layer == "streaming"
+        assert config.detect_rule(WinInfo("obs", "Recording")).layer == "streaming"
+        assert config.detect_rule(WinInfo("obsidian", "Recording")).layer == "media"
+
+    def test_bucket_candidates_drop_other_classes(self):
+        rules = [
+            {"class": "chrome", "layer": "dev"},
+            {"title": "Recording", "layer": "media"},
+            {"class": "^obs$", "layer": "streaming"},
+        ]
+        config = Config(encode_config(rules), DummyKanata(KANATA_LAYERS))
+        assert [c.index for c in config._candidates["obs"]] == [2, 3]
+        assert "obs" not in config._class_only
+        assert config.detect_rule(WinInfo("obs", "Recording")).layer == "media"
+        assert config.detect_rule(WinInfo("obs", "Scene")).layer == "streaming"
@@ -0,0 +1,23 @@
+import pytest
+from src.hyprkan import Hyprland, WinInfo
+
+
+class TestParseActiveWindow:
+
+    @pytest.mark.parametrize(
+        "payload,expected",
+        [
+            ("kitty,vim", WinInfo("kitty", "vim")),
+            (
+                "firefox,Foo, Bar - Mozilla",
+                WinInfo("firefox", "Foo, Bar - Mozilla"),
+            ),
+            (",", WinInfo("*", "*")),
+            ("code,", WinInfo("code", "*")),
+        ],
+    )
+    def test_parse_payload(self, payload, expected):
+        assert Hyprland._parse_active_window(payload) == expected
+
+    def test_parse_malformed_payload(self):
+        assert Hyprland._parse_active_window("garbage") is None
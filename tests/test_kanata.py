@@ -0,0 +1,128 @@
+import json
+import select
+import selectors
+import socket
+import pytest
+from src.hyprkan import Kanata
+
+
+@pytest.fixture(name="kanata")
+def fixture_kanata():
+    client = Kanata(("127.0.0.1", 10000))
+    yield client
+    client._client.close()
+
+
+class TestPopMessages:
+
+    def test_pop_complete_messages(self, kanata):
+        kanata._buffer += (
+            b'{"LayerChange":{"new":"a"}}\n{"CurrentLayerName":{"name":"a"}}\n{"La'
+        )
+        assert kanata._pop_messages() == [
+            {"LayerChange": {"new": "a"}},
+            {"CurrentLayerName": {"name": "a"}},
+        ]
+        assert kanata._buffer == b'{"La'
+
+    def test_pop_skips_malformed_lines(self, kanata):
+        kanata._buffer += b'not json\n\n{"LayerNames":{"names":["a"]}}\n'
+        assert kanata._pop_messages() == [{"LayerNames": {"names": ["a"]}}]
+        assert kanata._buffer == b""
+
+
+class TestTrackLayer:
+
+    def test_layer_change_updates_cached_layer(self, kanata):
+        kanata._track_layer({"LayerChange": {"new": "media"}})
+        assert kanata._current_layer == "media"
+
+    def test_other_messages_are_ignored(self, kanata):
+        kanata._current_layer = "base"
+        kanata._track_layer({"CurrentLayerInfo": {"name": "media"}})
+        assert kanata._current_layer == "base"
+
+
+class TestRead:
+
+    def test_read_appends_to_buffer(self, kanata):
+        kanata._client.close()
+        kanata._client, server = socket.socketpair()
+        kanata._selector = selectors.DefaultSelector()
+        kanata._selector.register(kanata._client, selectors.EVENT_READ)
+
+        assert not kanata._read(0)
+        server.sendall(b'{"LayerChange":')
+        assert kanata._read(0.5)
+        server.sendall(b'{"new":"a"}}\n')
+        server.close()
+        assert kanata._read(0.5)
+        with pytest.raises(ConnectionResetError):
+            kanata._read(0.5)  # closed by the server
+        assert kanata._pop_messages() == [{"LayerChange": {"new": "a"}}]
+        kanata._drop_socket()
+
+
+class RecordingKanata(Kanata):
+    def __init__(self):
+        super().__init__(("127.0.0.1", 10000))
+        self._connected = True
+        self.sent: list[dict] = []
+
+    def _flush_buffer(self):
+        pass
+
+    def send(self, msg: bytes, expect=None):
+        del expect  # nothing answers, so there is no response to wait for
+        assert msg.endswith(b"\n")
+        self.sent.extend(json.loads(line) for line in msg.splitlines())
+        return {}
+
+
+class TestRequests:
+
+    def test_requests_are_valid_json(self):
+        recorder = RecordingKanata()
+        recorder.change_layer('we"ird\\layer')
+        recorder.act_on_fake_key(("Space", "tap"))
+        recorder.set_mouse((300, 400))
+        recorder._client.close()
+        assert recorder.sent == [
+            {"ChangeLayer": {"new": 'we"ird\\layer'}},
+            {"ActOnFakeKey": {"name": "Space", "action": "Tap"}},
+            {"SetMouse": {"x": 300, "y": 400}},
+        ]
+
+    def test_follow_up_requests_share_the_layer_change_write(self):
+        recorder = RecordingKanata()
+        writes = []
+        recorder.send = lambda msg, expect=None: writes.append(msg) or {}
+        follow_up = (
+            recorder.fake_key_msg(("Space", "tap")),
+            recorder.set_mouse_msg((1, 2)),
+        )
+        assert recorder.change_layer("media", *follow_up)
+        assert not recorder.change_layer("media", *follow_up)
+        recorder._client.close()
+        assert writes == [recorder._TPL_CHANGE_LAYER % b'"media"' + b"".join(follow_up)]
+
+
+def test_first_request_after_restart_reaches_new_server(monkeypatch):
+    monkeypatch.setattr(Kanata, "_RECONNECT_DELAYS", (0,))
+    with socket.create_server(("127.0.0.1", 0)) as server:
+        server.settimeout(1)
+        client = Kanata(server.getsockname())
+        assert client.change_layer("a")
+        server.accept()[0].close()  # kanata restarts
+        select.select([client._client], [], [], 1)  # wait for the FIN
+
+        assert client.change_layer("b")
+        new, _ = server.accept()
+        new.settimeout(1)
+        received = b""
+        while b'{"ChangeLayer":{"new":"b"}}' not in received:
+            chunk = new.recv(4096)
+            assert chunk, "ChangeLayer was not sent to the new connection"
+            received += chunk
+        new.close()
+        client.close()
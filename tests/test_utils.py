@@ -1,3 +1,8 @@
+import os
+import shutil
+import socket
+import threading
+import time
 import pytest
 from src.hyprkan import utils
 
@@ -37,6 +42,8 @@ class TestValidatePort:
             "127.0.0.1",
             "1.1.1.1:",
             ":8080",
+            "²",
+            "127.0.0.01:80",
         ],
     )
     def test_invalid_ports(self, invalid_input, caplog):
@@ -47,13 +54,123 @@ class TestValidatePort:
 
 class TestRunCommand:
 
-    def test_run_cmd(self):
-        utils._run_cmd("whoami")
+    def test_run_cmd(self, caplog):
+        with caplog.at_level("ERROR"):
+            utils.run_cmd_bg("whoami").result()
+        assert not caplog.text
 
     def test_run_cmd_failure(self, caplog):
-        with caplog.at_level("ERROR"), pytest.raises(SystemExit):
-            utils._run_cmd("nonexistent_command_xyz")
-            assert "Error occurred while running command" in caplog.text
+        with caplog.at_level("ERROR"):
+            utils.run_cmd_bg("nonexistent_command_xyz").result()
+        assert "Error occurred while running command" in caplog.text
+        assert "nonexistent_command_xyz" in caplog.text
+
+    @pytest.mark.parametrize(
+        "cmd, expected",
+        [
+            ("whoami", ["whoami"]),
+            ("  whoami --help  ", ["whoami", "--help"]),
+            ("whoami\nwhoami", None),
+            ("whoami > /dev/null", None),
+            ("echo $HOME", None),
+            ("echo 'a b'", None),
+            ("ls ~", None),
+            ("LANG=C whoami", None),
+            ("nonexistent_command_xyz", None),
+        ],
+    )
+    def test_split_simple_cmd(self, cmd, expected):
+        args = utils._split_simple_cmd(cmd)
+        if expected is None:
+            assert args is None
+        else:
+            assert args[0] == shutil.which(expected[0])
+            assert args[1:] == expected[1:]
+
+    def test_run_script_without_shebang(self, tmp_path, monkeypatch, caplog):
+        marker = tmp_path / "ran"
+        script = tmp_path / "noshebang_xyz"
+        script.write_text(f"touch {marker}\n")
+        script.chmod(0o755)
+        monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+        utils._which.cache_clear()
+
+        with caplog.at_level("ERROR"):
+            utils.run_cmd_bg("noshebang_xyz").result()
+        assert not caplog.text
+        assert marker.exists()
+
+    def test_run_cmd_moved_after_lookup(self, tmp_path, monkeypatch, caplog):
+        old_dir, new_dir = tmp_path / "old", tmp_path / "new"
+        old_dir.mkdir()
+        new_dir.mkdir()
+        marker = tmp_path / "ran"
+        script = old_dir / "moved_xyz"
+        script.write_text(f"#!/bin/sh\ntouch {marker}\n")
+        script.chmod(0o755)
+        monkeypatch.setenv("PATH", f"{old_dir}:{new_dir}:{os.environ['PATH']}")
+        utils._which.cache_clear()
+        assert utils._split_simple_cmd("moved_xyz") == [str(script)]
+
+        script.rename(new_dir / "moved_xyz")
+        with caplog.at_level("ERROR"):
+            utils.run_cmd_bg("moved_xyz").result()
+        assert not caplog.text
+        assert marker.exists()
+        assert utils._split_simple_cmd("moved_xyz") == [str(new_dir / "moved_xyz")]
+
+    def test_run_cmd_failure_without_shell(self, caplog):
+        with caplog.at_level("ERROR"):
+            utils.run_cmd_bg("ls /nonexistent_dir_xyz").result()
+        assert "'ls /nonexistent_dir_xyz': exit status" in caplog.text
+
+    def test_long_running_cmds_release_the_pool(self, caplog):
+        with caplog.at_level("ERROR"):
+            waits = [utils.run_cmd_bg("sleep 3") for _ in range(5)]
+            # Each wait returns after the 1 s grace period instead of requeueing
+            for wait in waits:
+                wait.result(timeout=2.5)
+            utils.run_cmd_bg("whoami").result(timeout=2.5)
+        assert not caplog.text
+        # All of them are watched by the one reaper thread
+        names = [t.name for t in threading.enumerate() if t.name.startswith("hyprkan")]
+        assert names.count("hyprkan-cmd-reaper") == 1
+        assert len(names) <= 5  # four pool workers and the reaper
+
+    def test_long_running_cmd_failure_is_logged(self, caplog):
+        with caplog.at_level("ERROR"):
+            utils.run_cmd_bg("sh -c 'sleep 1.2; echo oops >&2; exit 3'").result()
+            deadline = time.monotonic() + 3
+            while "exit status 3" not in caplog.text and time.monotonic() < deadline:
+                time.sleep(0.05)
+        assert "exit status 3\noops" in caplog.text
+
+
+class TestPopLines:
+
+    def test_pop_complete_lines(self):
+        buf = bytearray(b"one\ntwo\nthr")
+        assert utils.pop_lines(buf) == [b"one", b"two"]
+        assert buf == b"thr"
+
+    def test_pop_no_complete_line(self):
+        buf = bytearray(b"partial")
+        assert utils.pop_lines(buf) == []
+        assert buf == b"partial"
+
+    def test_pop_keeps_empty_lines(self):
+        buf = bytearray(b"a\n\nb\n")
+        assert utils.pop_lines(buf) == [b"a", b"", b"b"]
+        assert buf == b""
+
+
+def test_recv_until_eof():
+    payload = b"x" * 10000
+    left, right = socket.socketpair()
+    with left, right:
+        right.sendall(payload)
+        right.shutdown(socket.SHUT_WR)
+        assert utils.recv_until_eof(left) == payload
 
 
 class TestRequireEnv:
@@ -85,3 +202,7 @@ class TestValidateFakeKey:
             utils.validate_fake_key(fake_key, rule_no)
 
         assert expected_message in caplog.text
+
+    @pytest.mark.parametrize("action", ["tap", "TAP", "Tap", "tAp"])
+    def test_action_is_normalized(self, action):
+        assert utils.validate_fake_key(("Space", action), None) == ("Space", "Tap")